@@ -1,8 +1,17 @@
-from random import uniform
-import matplotlib.pyplot as plt
+import os
+from array import array
+from bisect import bisect_right
+from random import Random
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from functools import wraps
 
-plt.style.use('ggplot')
+## Numba is optional: without it the compiled sampler is unavailable and the NumPy batch sampler is used instead.
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 '''Using Descriptors to complete the TypeChecking - more elegant but less explicit approach.'''
 class Descriptor_:
@@ -40,51 +49,101 @@ class TypeChecked(Descriptor_):
 class List(TypeChecked):
     ty = list
 
-## The Method Resolution Order will ensure that the List is validated first before determining whether every element inside the List is an Integer.
-class _Integers(Descriptor_):
+## Fused Descriptors: rather than combining List with a second mixin, and resolving __set__ through two hops of the MRO, perform both checks in a single __set__.
+## This keeps the cost of construction low when many Random Variables are instantiated, e.g. inside the outer loop of a Monte Carlo simulation.
+class ListOfInt(Descriptor_):
 
-    ## The "value" argument will, as validated by the previous Class, be a List.
+    ## Let NumPy infer the dtype of the List in a single C pass, rather than checking the Type of each element in Python: only a flat List of Integers will be inferred as a signed integer Array.
+    ## NumPy will however infer a signed integer Array for a List mixing Integers and Booleans, hence reject Booleans explicitly: both map() and the containment check run in C and stop at the first Boolean.
+    ## Python's Integers are unbounded: those beyond the range of int64 are inferred as uint64 or object instead, hence fall back to checking the Type of each element for those Lists.
     def __set__(self, instance, value):
-        if not (all(list(map(lambda arg: isinstance(arg, int), value)))):
-            raise TypeError("The List passed must consist of all Integer Values.")
+        if type(value) is not list:
+            raise TypeError (f"Expected {list} for field: {self.name}.")
+        ## An empty List is vacuously a List of Integers, although NumPy would infer it as float64.
+        if not value:
+            arr = np.empty(0, dtype = np.int64)
+        else:
+            try:
+                arr = np.asarray(value)
+            except ValueError:
+                arr = None
+            if arr is None or arr.ndim != 1:
+                raise TypeError("The List passed must consist of all Integer Values.")
+            if arr.dtype.kind == 'i':
+                if bool in map(type, value):
+                    raise TypeError("The List passed must consist of all Integer Values.")
+            elif arr.dtype.kind in 'uO':
+                if not all(type(arg) is int for arg in value):
+                    raise TypeError("The List passed must consist of all Integer Values.")
+                ## Hold the exact Integers in an object Array, as they do not fit in int64.
+                arr = np.array(value, dtype = object)
+            else:
+                raise TypeError("The List passed must consist of all Integer Values.")
+        ## Stash the validated Array such that the Constructor can reuse it.
+        instance.__dict__['_elements_arr'] = arr
         super().__set__(instance, value)
 
-class _Probabilities(Descriptor_):
-    
+class ListOfProbabilities(Descriptor_):
+
     def __set__(self, instance, value):
+        if type(value) is not list:
+            raise TypeError (f"Expected {list} for field: {self.name}.")
+        ## An empty List cannot sum to 1.0: report it as the empty finite sample space it represents, as RandomGen does.
+        if not value:
+            raise ValueError("Expecting at least one element.")
+        ## Validate the Types with the dtype NumPy infers in a single C pass: anything other than a flat List of numbers (e.g. Strings or None) will not be inferred as a numeric Array.
         try:
-            _sum = sum(value)
-        except TypeError as err:
+            arr = np.asarray(value)
+            if arr.ndim != 1 or arr.dtype.kind not in 'iuf':
+                raise TypeError(f"expected a flat List of numbers, inferred {arr.dtype} of {arr.ndim} dimension(s)")
+        except (TypeError, ValueError) as err:
             print(f"Probabilities required: {err}.")
             raise
         else:
+            ## Sum with a single C reduction (NumPy's pairwise summation), which is both faster and accumulates less rounding error than the built-in sum() for long vectors.
+            arr = arr.astype(np.float64)
+            _sum = float(arr.sum())
             if abs(_sum - 1.0) < 0.0001:
+                ## Normalise once, at assignment, such that the samplers downstream see a distribution which sums to 1.0 rather than one which is silently biased by up to Epsilon.
+                ## Stash the Array such that the Constructor can reuse it rather than converting the List a second time. The field itself retains the List as passed, for display.
+                arr /= _sum
+                instance.__dict__['_probs_arr'] = arr
                 super().__set__(instance, value)
             else:
                 raise ValueError("Must be within Epsilon of 1.0.")
 
 
-## Combine the two Type Checks into a single Descriptor.
-class List_Integers(List, _Integers):
-    pass
+## Returns the CDF both as an Array, for np.searchsorted(), and as a List, for bisect and random.choices().
+## Pin the final value of the CDF to 1.0 such that a uniform draw can never fall beyond the last element. For normalised probabilities this only absorbs the rounding of the cumulative sum.
+def _cumulative(probs_arr):
+    cdf = np.cumsum(probs_arr)
+    cdf[-1] = 1.0
+    return cdf, cdf.tolist()
 
-## Alternative approach to defining the above Class. The second parameter will represent the inheritance structure and the third parameter is a dictionary of the Class's methods.
-List_Integers_ = type('List_Integers_', (List_Integers, ), {})
-
-class List_Probabilities(List, _Probabilities):
-    pass
+## Retain the previous names of the combined Descriptors.
+List_Integers = ListOfInt
+List_Integers_ = ListOfInt
+List_Probabilities = ListOfProbabilities
 
 
 '''Using a Decorator to indicate which function has been called in the Procedural Section of the Code.'''
 ## Utilise a prefix to distinguish each function. This is a boon when trying to isolate an error in procedural code.
+## The output is only enabled by setting the environment variable RV_DEBUG=1; the value is read once, when the module is imported.
+_DEBUG_ENABLED = os.getenv('RV_DEBUG') == '1'
+
 def debug(prefix = ' '):
     ## The function debug() will return a Decorator having defined the prefix inside the Enclosing Scope. The argument, 'prefix', will be accessible inside the entire scope of the constructed wrapper.
 
+    ## The prefix passed can only be of Type String. The check is made once per call to debug(), not once per decorated function.
+    prefixed = isinstance(prefix, str)
+
     def decorator(func):
-        ## The method __qualname__() will display the name of a user-defined function or Class.
+        ## When disabled, hand back the function itself such that the decorated call carries zero overhead.
+        if not _DEBUG_ENABLED:
+            return func
 
-        ## The prefix passed can only be of Type String.
-        if isinstance(prefix, str):
+        ## The method __qualname__() will display the name of a user-defined function or Class.
+        if prefixed:
             try:
                 msg = prefix + func.__qualname__
             except AttributeError:
@@ -104,32 +163,151 @@ def debug(prefix = ' '):
 ## The purpose of any Decorator is to wrap a function in additional functionality: the original function will be returned having engaged the additional logic.
 
 
+'''Compiled Sampling Loop.'''
+## The whole n-iteration loop over the alias tables runs as native code, with the PRNG inlined, rather than paying the interpreter's dispatch per sample.
+## Numba holds its own PRNG state, separate from NumPy's: seed it on every call, from the instance's Generator, such that the compiled sampler is reproducible too.
+def _alias_sample_loop(q, alias, n, out, seed):
+    np.random.seed(seed)
+    K = len(q)
+    for i in range(n):
+        j = int(np.random.random() * K)
+        out[i] = j if np.random.random() < q[j] else alias[j]
+    return out
+
+if njit is not None:
+    _alias_sample_loop = njit(cache = True)(_alias_sample_loop)
+
+
+## Sentinel for a ladder which is due, but yet to be compiled by next_idx().
+_UNCOMPILED = object()
+
+
 '''Logic Class representing the Random Variable.'''
 ## The Class will be able to handle any number of Integers with the assigned probabilities representing a Probability Mass Function, finite sample space.
 class RandomGen(object):
-
-    def __init__(self, elements, probabilities):
+    ## Number of uniforms generated per refill of the buffer consumed by next_num().
+    _buffer_size = 65536
+    ## Largest finite sample space for which next_idx() uses a generated, unrolled sampler rather than a binary search of the CDF.
+    _ladder_max = 8
+    ## The fields from which every table is derived, mapped to the Array stashed for each.
+    _stashes = {'elements': '_elements_arr', 'probabilities': '_probs_arr'}
+
+    ## The optional seed is anything accepted by np.random.default_rng(): None, an Integer, a SeedSequence or an existing Generator.
+    ## Every sampler draws from the resulting Generator, or from a stream seeded by it, hence a single seed reproduces the output of each of them.
+    def __init__(self, elements, probabilities, seed = None):
         self.elements = elements
         self.probabilities = probabilities
-        self.l_elem = len(elements)
-        self.l_prob = len(probabilities)
+        self._build()
+        ## PCG64 Generator: refill a buffer of uniforms in one C call and consume from it, amortising the cost of the call across every sample.
+        ## The buffer starts empty and is only filled on the first draw by next_idx(), such that construction stays cheap and callers of the batch samplers never pay for it.
+        self._rng = np.random.default_rng(seed)
+        self._uniforms = iter(())
+        ## The Standard Library sampler draws from its own Mersenne Twister, seeded from the Generator, rather than the global state of the random module. It is seeded on the first call to sample_n().
+        self._random = None
+
+    ## Every table the samplers read is derived from the two fields in this one place: once by the Constructor, then again whenever either field is reassigned.
+    def _build(self):
+        self.l_elem = len(self.elements)
+        self.l_prob = len(self.probabilities)
+        ## Validate the mapping of each element to a probability once, at construction, such that a mismatch fails fast rather than on the first sample.
+        if (self.l_elem != self.l_prob):
+            raise ValueError("Expecting to map each element to a probability.")
+        ## Every sampler falls back to the last element, hence the finite sample space cannot be empty.
+        if not self.l_elem:
+            raise ValueError("Expecting at least one element.")
+        self._pairs = list(zip(self.elements, self.probabilities))
+        ## Structure of Arrays: hold the elements and probabilities as two contiguous Arrays, rather than a List of (element, probability) tuples.
+        ## The Descriptors of a Random Variable will already have stashed the validated Arrays.
+        if '_elements_arr' not in self.__dict__:
+            self._elements_arr = np.asarray(self.elements)
+        if '_probs_arr' not in self.__dict__:
+            self._probs_arr = np.asarray(self.probabilities, dtype = np.float64)
+        ## Materialise the CDF once, such that no sampler needs to accumulate the probabilities per sample.
+        self._cdf, self._cum_probs = _cumulative(self._probs_arr)
+        ## Only the compiled sampler reads the alias tables, hence they are built on its first call rather than here.
+        self._q_arr = self._alias_arr = None
+        ## Compiling the ladder costs an exec(), hence defer it to the first draw by next_idx() such that construction, and every caller of the batch samplers, never pays for it.
+        self._ladder = _UNCOMPILED if self.l_elem <= self._ladder_max else None
+        self._indices = list(range(self.l_elem))
+
+    ## Reassigning either field discards the Array derived from its previous value (a Descriptor stashes a fresh one as it sets the field), then rebuilds the tables such that every sampler follows the reassignment.
+    ## Should the new value be rejected, e.g. a different number of elements to probabilities, the previous value is restored before the error is raised, leaving the samplers consistent. To change the size of the finite sample space, instantiate a new Random Variable.
+    def __setattr__(self, name, value):
+        stash = self._stashes.get(name)
+        if stash is None:
+            return super().__setattr__(name, value)
+        saved = {key: self.__dict__[key] for key in (name, stash) if key in self.__dict__}
+        self.__dict__.pop(stash, None)
+        try:
+            super().__setattr__(name, value)
+            if '_cdf' in self.__dict__:
+                self._build()
+        except (TypeError, ValueError):
+            self.__dict__.pop(stash, None)
+            self.__dict__.update(saved)
+            if '_cdf' in self.__dict__:
+                self._build()
+            raise
 
+    ## The (element, probability) tuples are built once by _build(); return a copy such that the cached List cannot be mutated.
     def list_tuple(self):
-        if (self.l_elem == self.l_prob):
-            return list(zip(self.elements, self.probabilities))
-        else:
-            raise ValueError("Expecting to map each element to a probability.")
+        return list(self._pairs)
+
+    ## Vose's Alias Method: split the scaled probabilities into K columns of height 1.0, each holding at most two elements - itself, with probability q[i], and its alias.
+    ## The tables are built once in O(K) so that every subsequent sample drawn by the compiled sampler is O(1), independent of the size of the finite sample space.
+    def _alias_tables(self):
+        K = self.l_elem
+        ## Take the column heights from the CDF, whose final value is pinned to 1.0, rather than the raw probabilities: the compiled sampler then draws the same distribution as every other sampler, even for weights which do not sum to 1.0.
+        p = (np.diff(self._cdf, prepend = 0.0) * K).tolist()
+        q = [1.0] * K
+        alias = list(range(K))
+        small = deque(i for i, x in enumerate(p) if x < 1.0)
+        large = deque(i for i, x in enumerate(p) if x >= 1.0)
+
+        while small and large:
+            s, l = small.popleft(), large.popleft()
+            q[s] = p[s]
+            alias[s] = l
+            p[l] -= (1.0 - p[s])
+            if p[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        ## Any remaining columns are full up to rounding error, hence keep q[i] = 1.0 for them.
+        return q, alias
+
+    ## Held as a List such that each draw returns a Python float, rather than boxing a NumPy scalar on every index.
+    ## Consuming the buffer through an iterator avoids storing an index back onto the instance on every draw.
+    def _next_u(self):
+        try:
+            return next(self._uniforms)
+        except StopIteration:
+            self._uniforms = iter(self._rng.random(self._buffer_size).tolist())
+            return next(self._uniforms)
+
+    ## For a small finite sample space, generate a sampler specific to this distribution: an unrolled chain of comparisons, with the bounds of the CDF baked in as float literals.
+    ## The compiled function needs a single uniform, has no loop, and performs no attribute lookups, e.g. for K = 3: "def ladder(r): return 0 if r < 0.3 else 1 if r < 0.9 else 2".
+    def _build_ladder(self):
+        bounds = self._cum_probs[:-1]
+        src = "def ladder(r): return " + "".join(f"{i} if r < {c!r} else " for i, c in enumerate(bounds)) + f"{len(bounds)}"
+        namespace = {}
+        exec(src, namespace)
+        return namespace['ladder']
+
+    ## Return the index into the elements of the next sample, such that callers can tally against a fixed index space.
+    def next_idx(self):
+        ladder = self._ladder
+        if ladder is not None:
+            if ladder is _UNCOMPILED:
+                ladder = self._ladder = self._build_ladder()
+            return ladder(self._next_u())
+        ## Binary search of the cached CDF in C: log2(K) comparisons and a single uniform per sample.
+        ## This outperforms walking the alias tables from Python, which requires two uniforms, until K is of the order of 10^5; the alias tables are retained for the compiled sampler.
+        ## The final value of the CDF is pinned to 1.0, therefore a uniform which exceeds every other bound explicitly maps onto the last index, K - 1, in both this path and the ladder.
+        return bisect_right(self._cum_probs, self._next_u())
 
     def next_num(self):
-        list_ = self.list_tuple()
-        r = uniform(0, 1)
-        cdf = 0
-        ## Iterate through the List consisting of each element from the finite sample space with the associated probability wrapped in a tuple.
-        for item, prob in list_:
-            cdf += prob
-            if cdf >= r:
-                return item
-        return item
+        return self.elements[self.next_idx()]
 
     ## By using a Generator it potentially avoids any wastage of memory by avoiding assignment to a variable and subsequently occupying Cache, or storing each computed value in a List.
     ## It should be noted that iterating through a Generator is slower than a List as the List is stored in memory. This discrepancy is amplified when comparing against an Array which will benefit from Spatial Locality.
@@ -137,45 +315,90 @@ class RandomGen(object):
         for i in range(n):
             yield self.next_num()
 
-    def get_elements(self):
-        return self.elements
+    ## Draw all n uniforms in a single call and map each onto the CDF with a binary search: one C loop over a contiguous Array rather than n trips through the interpreter.
+    ## The batch samplers return the index into the elements of each sample; recover the elements themselves, if required, with self._elements_arr[idx].
+    def sample_batch(self, n):
+        return self._sample_batch(self._rng, n)
+
+    def _sample_batch(self, rng, n):
+        u = rng.random(n)
+        return np.searchsorted(self._cdf, u, side = 'right')
+
+    ## Split a large batch across worker threads; NumPy releases the GIL inside both the Generator and the search, hence the workers run concurrently.
+    ## Each worker draws from its own PCG64 stream, spawned from the SeedSequence of the instance's Generator, such that the streams are independent of one another rather than overlapping.
+    def sample_batch_parallel(self, n, workers = None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        elif workers < 1:
+            raise ValueError("Expecting at least one worker.")
+        sizes = [n // workers + (1 if i < n % workers else 0) for i in range(workers)]
+        rngs = self._rng.spawn(workers)
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            return np.concatenate(list(executor.map(self._sample_batch, rngs, sizes)))
+
+    ## Standard Library batch sampler: random.choices() performs both the PRNG and the bisection of the cumulative weights in C. As with the other batch samplers, the n indices drawn are returned.
+    def sample_n(self, n):
+        if self._random is None:
+            self._random = Random(int(self._rng.integers(2**63)))
+        return self._random.choices(self._indices, cum_weights = self._cum_probs, k = n)
+
+    def sample_batch_numba(self, n):
+        if njit is None:
+            return self.sample_batch(n)
+        if self._q_arr is None:
+            q, alias = self._alias_tables()
+            self._q_arr = np.asarray(q, dtype = np.float64)
+            self._alias_arr = np.asarray(alias, dtype = np.int64)
+        out = np.empty(n, dtype = np.int64)
+        return _alias_sample_loop(self._q_arr, self._alias_arr, n, out, int(self._rng.integers(2**32)))
 
-    def get_probabilities(self):
-        return self.probabilities
     
 
 ## Will inherit the Constructor from the Parent Class which will set the fields to the respective attributes passed.
 ## The subclass will control the application of the Descriptors to complete the Type Checking.
 class RV(RandomGen):
-    elements = List_Integers_('elements')
-    probabilities = List_Probabilities('probabilities')
+    elements = ListOfInt('elements')
+    probabilities = ListOfProbabilities('probabilities')
 
 
+## Fold the K per-index counts into the String keyed dictionary. The same element may appear more than once in the finite sample space, hence add each index's count into its key rather than overwriting it.
+def _keyed_counts(elements, counts):
+    dict_ = dict.fromkeys(map(str, elements), 0)
+    for elem, count in zip(elements, counts):
+        dict_[str(elem)] += count
+    return dict_
+
 ## The second parameter will be an instance of the above Class, "RV".
 ## Keep the below subroutines out of the Class, as the Class represents a Random Variable. Therefore, not technically part of its body of logic.
 def generator_(n, data):
-    keys = [str(_) for _ in data.get_elements()]
-    dict_ = dict(zip(keys, [0 for _ in keys]))
-    for i in range(n):
-        output = data.next_num()
-        dict_[str(output)] += 1
-    return dict_
-
-## Second implementation using the module consisting of a Generator.
-@debug(prefix = "Decorator - Using the Class's method that consists of a Generator: ")
+    elements = data.elements
+    ## The index space is known and fixed: tally into a preallocated Array of K counts, converting to the String keyed dictionary once at the end.
+    ## Both the sampling and the counting (collections.Counter) run in C, leaving only K stores into the Array for the interpreter.
+    counts = array('q', [0]) * len(elements)
+    for i, count in Counter(data.sample_n(n)).items():
+        counts[i] = count
+    return _keyed_counts(elements, counts)
+
+## Second implementation using the vectorised batch sampler.
+@debug(prefix = "Decorator - Using the Class's vectorised batch sampler: ")
 def generator(n, data):
-    keys = [str(_) for _ in data.get_elements()]
-    dict_ = dict(zip(keys, [0 for _ in keys]))
-    nums = data.generator_next(n)
-
-    ## Greater number of Loops but lower memory impact.
-    for elem in nums:
-        dict_[str(elem)] += 1
-    return dict_
+    elements = data.elements
+    ## Count the occurrences of each index in one pass; the String keys are only built once, for the returned dictionary.
+    counts = np.bincount(data.sample_batch(n), minlength = len(elements))
+    return _keyed_counts(elements, counts.tolist())
 
 '''Display the Output.'''
+## Matplotlib is only imported once a chart is drawn, such that sampling from the Random Variable does not pay for loading it. Apply the style once, on the first call.
+_style_applied = False
+
 def bar_chart(dict_, data):
-    x = list(zip(dict_.keys(), data.get_probabilities()))
+    global _style_applied
+    import matplotlib.pyplot as plt
+    if not _style_applied:
+        plt.style.use('ggplot')
+        _style_applied = True
+
+    x = list(zip(dict_.keys(), data.probabilities))
     numeracy = list(dict_.values())
 
     x_pos = [i for i, _ in enumerate(x)]
@@ -207,7 +430,7 @@ def probability(dict_, n, prob_):
 
 '''Test Case.'''
 if __name__ == '__main__':
-## If there is an imbalance with the number of finite elements and the associated probability, the error will only be generated once the user tries to generate values from the Random Variable.
+## If there is an imbalance with the number of finite elements and the associated probability, the error will be generated as soon as the Random Variable is instantiated.
     elements = [-1, 0, 1, 2, 3]
     probabilities = [0.01, 0.3, 0.58, 0.1, 0.01]
     
@@ -220,6 +443,16 @@ if __name__ == '__main__':
     ## Unit Tests.
     test_sum(dict_, n)
     prob_sum(dict_, n)
+    ## Every batch sampler returns n indices: the counts over the finite sample space must sum to n.
+    for sampler in (inst.sample_batch, inst.sample_batch_parallel, inst.sample_n, inst.sample_batch_numba):
+        counts = _keyed_counts(elements, np.bincount(sampler(n), minlength = len(elements)).tolist())
+        test_sum(counts, n)
+        prob_sum(counts, n)
+    ## A seeded Random Variable reproduces its samples.
+    seeded, reseeded = RV(elements, probabilities, seed = 0), RV(elements, probabilities, seed = 0)
+    assert np.array_equal(seeded.sample_batch(n), reseeded.sample_batch(n)), "Should reproduce the same samples for the same seed."
+    assert seeded.sample_n(n) == reseeded.sample_n(n), "Should reproduce the same samples for the same seed."
+    assert [seeded.next_num() for _ in range(n)] == [reseeded.next_num() for _ in range(n)], "Should reproduce the same samples for the same seed."
     ## As discussed above, only applicable for a large sample size.
     if n > 100000:
         probability(dict_, n, probabilities)